@@ -2,4 +2,4 @@
 
 source /home/orcfax/itn-api/api.env
 
-/home/orcfax/itn-api/venv/bin/python /home/orcfax/itn-api/itn_api.py --workers 5
+cd /home/orcfax/itn-api/ && /home/orcfax/itn-api/venv/bin/python -m src.itn_api.api --workers 5
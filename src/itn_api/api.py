@@ -5,6 +5,10 @@ the ITN output.
 
     `uvicorn src.itn_api.api:app --reload`
 
+Or via the entry point, e.g. from the root of the repository:
+
+    `python -m src.itn_api.api --workers 5`
+
 The database for this app is configured by the DATABASE_PATH environment
 variable.
 """
@@ -12,10 +16,12 @@ variable.
 # pylint: disable=W0621
 
 import argparse
+import asyncio
 import importlib
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Final
@@ -23,19 +29,17 @@ from typing import Final
 import apsw
 import apsw.bestpractice
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
-
-try:
-    import htm_helpers
-    import reports
-except ImportError:
-    try:
-        from src.itn_api import htm_helpers, reports
-    except ImportError:
-        from itn_api import htm_helpers, reports
+from fastapi.responses import (
+    HTMLResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 
+from . import helpers, htm_helpers, reports
 
 # Set up logging.
 logging.basicConfig(
@@ -79,6 +83,83 @@ tags_metadata = [
     },
 ]
 
+# Seconds to cache the results of read-only endpoints for. The validator
+# writes to the database continuously so caches are expired by this TTL
+# alone, i.e. responses may be up to this many seconds behind.
+CACHE_TTL: Final[int] = 60
+
+# Seconds browsers may re-use an HTMX response before revalidating it.
+HTTP_MAX_AGE: Final[int] = 30
+
+# Number of read-only database connections held by each worker. Queries
+# run in a thread pool of the same size.
+POOL_SIZE: Final[int] = 4
+
+# Size of the per-connection prepared statement cache. Each of the
+# queries below is prepared once and then re-used on subsequent calls.
+STATEMENT_CACHE_SIZE: Final[int] = 200
+
+# Indexes supporting the statistics queries, created by running the API
+# once with `--create-indexes`. Keys are index names and values are the
+# indexed columns. `idx_dp_dt_addr` also serves lookups
+# by date_time and feed so no separate index is needed for them.
+INDEXES: Final[dict] = {
+    "idx_dp_addr_dt": "data_points(address, date_time)",
+    "idx_dp_dt_addr": "data_points(date_time, address, feed_id)",
+}
+
+# Milliseconds to wait for the validator's write lock when creating the
+# indexes above.
+INDEX_BUSY_TIMEOUT: Final[int] = 60000
+
+# PRAGMAs applied to each connection to suit a read-heavy workload: a
+# 128 MB page cache (negative values are KiB), memory-mapped reads,
+# in-memory temporary tables, and refusing writes.
+READ_PRAGMAS: Final[dict] = {
+    "cache_size": -131072,
+    "mmap_size": 30000000000,
+    "temp_store": "MEMORY",
+    "query_only": 1,
+}
+
+# Time windows bound into the queries below. Where a window filters
+# rows, the raw `date_time` is also compared against the window's start
+# date so that the date_time indexes can be searched, the `datetime()`
+# comparison then trims that day to the exact window.
+WINDOW_24_HOURS: Final[str] = "-24 hours"
+WINDOW_48_HOURS: Final[str] = "-48 hours"
+
+# Queries used by the API. Kept as constants so that the SQL text is
+# identical between calls and is served from the statement cache.
+SQL_ACTIVE_PARTICIPANTS: Final[str] = "select distinct address from data_points;"
+SQL_PARTICIPANTS_COUNT_TOTAL: Final[str] = (
+    "select count(*) as count, address from data_points "
+    "group by address order by count desc;"
+)
+SQL_COUNT_ACTIVE_PARTICIPANTS: Final[str] = (
+    "select count(distinct address) as count from data_points;"
+)
+SQL_COLLECTOR_COUNTS: Final[str] = (
+    """
+    SELECT address, total_count, count_24hr,
+    COALESCE(CAST(count_24hr * 1.0 / feeds AS INTEGER) + 1, 0) AS average_24hr,
+    COALESCE(CAST(count_24hr * 1.0 / feeds / 24 AS INTEGER) + 1, 0) AS average_1hr,
+    COALESCE(ROUND(count_24hr * 1.0 / feeds / 1440, 4), 0) AS average_1min
+    FROM (
+        SELECT address, COUNT(*) AS total_count,
+        SUM(CASE WHEN datetime(date_time) >= datetime('now', ?1)
+        THEN 1 ELSE 0 END) AS count_24hr,
+        (SELECT NULLIF(COUNT(DISTINCT feed_id), 0)
+        FROM data_points
+        WHERE date_time >= date('now', ?2)
+        AND datetime(date_time) >= datetime('now', ?2)) AS feeds
+        FROM data_points
+        GROUP BY address
+    )
+    ORDER BY total_count DESC;
+    """
+)
+
 
 def _enable_best_practice(connection: apsw.Connection):
     """Enable aspw best practice."""
@@ -86,18 +167,71 @@ def _enable_best_practice(connection: apsw.Connection):
     apsw.bestpractice.library_logging()
 
 
+def _apply_read_pragmas(connection: apsw.Connection):
+    """Configure the connection for read-only access."""
+    for pragma, value in READ_PRAGMAS.items():
+        connection.pragma(pragma, value)
+    logger.info("mmap_size: %s", connection.pragma("mmap_size"))
+
+
+def _ensure_indexes(db_path: Path):
+    """Create any missing indexes in the database.
+
+    This is a one-off migration run from the command line before the API
+    is started, not by each worker, as building an index on a large
+    table holds the write lock until it completes. The API otherwise
+    only reads from the database so it uses its own short-lived writable
+    connection. If the database cannot be written to, the API runs
+    without the indexes.
+    """
+    connection = apsw.Connection(str(db_path), flags=apsw.SQLITE_OPEN_READONLY)
+    indexes = connection.execute("select name from sqlite_master where type = 'index';")
+    existing = {row[0] for row in list(indexes)}
+    connection.close()
+    missing = {name: cols for name, cols in INDEXES.items() if name not in existing}
+    if not missing:
+        return
+    try:
+        connection = apsw.Connection(str(db_path), flags=apsw.SQLITE_OPEN_READWRITE)
+        connection.setbusytimeout(INDEX_BUSY_TIMEOUT)
+        with connection:
+            for name, cols in missing.items():
+                logger.info("creating index: %s", name)
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {cols};")
+        connection.close()
+    except apsw.Error as err:
+        logger.warning("unable to create indexes, queries may be slower: %s", err)
+
+
+def _connect(db_path: Path) -> apsw.Connection:
+    """Open a configured read-only connection to the database."""
+    connection = apsw.Connection(
+        str(db_path),
+        flags=apsw.SQLITE_OPEN_READONLY,
+        statementcachesize=STATEMENT_CACHE_SIZE,
+    )
+    _enable_best_practice(connection)
+    _apply_read_pragmas(connection)
+    return connection
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Load the database connection for the life of the app.s"""
+    """Load the database connection pool for the life of the app."""
     db_path = Path(os.environ["DATABASE_PATH"])
     logger.info("validator database: %s", db_path)
-    app.state.connection = apsw.Connection(
-        str(db_path), flags=apsw.SQLITE_OPEN_READONLY
+    app.state.pool = asyncio.Queue()
+    for _ in range(POOL_SIZE):
+        app.state.pool.put_nowait(_connect(db_path))
+    app.state.db_executor = ThreadPoolExecutor(
+        max_workers=POOL_SIZE, thread_name_prefix="db"
     )
-    _enable_best_practice(app.state.connection)
     app.state.kupo_url = os.environ["KUPO_URL"]
     app.state.kupo_port = os.environ["KUPO_PORT"]
     yield
+    app.state.db_executor.shutdown()
+    while not app.state.pool.empty():
+        app.state.pool.get_nowait().close()
 
 
 app = FastAPI(
@@ -109,19 +243,19 @@ app = FastAPI(
     },
     openapi_tags=tags_metadata,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     root_path="/api",
 )
 
-origins = [
-    "http://127.0.0.1:24001",
-    "*",
-]
+# The API is public and read-only so any origin may make GET requests.
+# Credentials cannot be combined with a wildcard origin.
+origins = ["*"]
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_credentials=False,
+    allow_methods=["GET"],
     allow_headers=["*"],
     expose_headers=["X-Content-type"],
 )
@@ -139,12 +273,11 @@ def redirect_root_to_docs():
 
 
 @app.get("/get_active_participants", tags=[TAG_STATISTICS])
+@helpers.ttl_cache(CACHE_TTL)
 async def get_active_participants():
     """Return participants in the ITN database."""
     try:
-        participants = app.state.connection.execute(
-            "select distinct address from data_points;"
-        )
+        participants = await helpers.db_exec(app, SQL_ACTIVE_PARTICIPANTS)
     except apsw.SQLError as err:
         return {"error": f"{err}"}
     data = [participant[0] for participant in participants]
@@ -152,11 +285,15 @@ async def get_active_participants():
 
 
 @app.get("/get_participants_counts_total", tags=[TAG_STATISTICS])
+@helpers.ttl_cache(CACHE_TTL)
 async def get_participants_counts_total():
     """Return participants total counts."""
     try:
-        participants_count_total = app.state.connection.execute(
-            "select count(*) as count, address from data_points group by address order by count desc;"
+        # `{count: address}` is the public shape of this endpoint, as
+        # output when FastAPI serialized the cursor itself. As it is keyed
+        # on count, only one of any addresses with equal counts is kept.
+        participants_count_total = dict(
+            await helpers.db_exec(app, SQL_PARTICIPANTS_COUNT_TOTAL)
         )
     except apsw.SQLError as err:
         return {"error": f"{err}"}
@@ -169,20 +306,21 @@ async def get_participants_counts_day(
 ):
     """Return participants in ITN."""
 
-    report = reports.get_participants_counts_date_range(app, date_start, date_end)
+    report = await reports.get_participants_counts_date_range(app, date_start, date_end)
     return report
 
 
-@app.get(
-    "/get_participants_counts_csv", tags=[TAG_STATISTICS], response_class=HTMLResponse
-)
+@app.get("/get_participants_counts_csv", tags=[TAG_STATISTICS])
 async def get_participants_counts_day_csv(
     date_start: str = "1970-01-01", date_end: str = "1970-01-03"
-) -> str:
+):
     """Return participants in ITN."""
-    report = reports.get_participants_counts_date_range(app, date_start, date_end)
-    csv_report = reports.generate_participant_count_csv(report)
-    return csv_report
+    report = await reports.get_participants_counts_date_range(app, date_start, date_end)
+    return StreamingResponse(
+        reports.generate_participant_count_csv(report),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="participants.csv"'},
+    )
 
 
 @app.get("/date_range", tags=[TAG_INFO])
@@ -192,13 +330,14 @@ async def get_date_range():
 
 
 @app.get("/itn_aliases_and_staking", tags=[TAG_INFO])
+@helpers.ttl_cache(CACHE_TTL)
 async def get_itn_aliases_and_staking(min_stake: int = 500000, license_no: str = None):
     """Return ITN aliases and stake values.
 
     Optionally: enter a license number, e.g. `#001` to see the details
     of a specific license.
     """
-    return reports.get_all_license_holders(app, min_stake, license_no)
+    return await reports.get_all_license_holders(app, min_stake, license_no)
 
 
 @app.get("/itn_aliases_and_staking_csv", tags=[TAG_INFO], response_class=HTMLResponse)
@@ -206,7 +345,7 @@ async def get_itn_aliases_and_staking_csv(
     min_stake: int = 500000, sort: str = "stake"
 ) -> str:
     """Return ITN aliases and stake values."""
-    return reports.get_all_license_holders_csv(app, min_stake, sort)
+    return await reports.get_all_license_holders_csv(app, min_stake, sort)
 
 
 @app.get("/geo", tags=[TAG_STATISTICS])
@@ -220,101 +359,101 @@ async def get_locations():
 # HTMX #################################################################
 
 
-@app.get("/participants", tags=[TAG_HTMX], response_class=HTMLResponse)
-async def get_itn_participants() -> str:
-    """Return ITN aliases and licenses."""
-    all_holders = reports.get_all_license_holders(app, 0, None)
-    htmx = htm_helpers.aliases_to_html(all_holders)
-    return htmx.strip()
+@helpers.ttl_cache(CACHE_TTL)
+async def _license_holders() -> list:
+    """Return all license holders for the participants table."""
+    return await reports.get_all_license_holders(app, 0, None)
 
 
-@app.get("/online_collectors", tags=[TAG_HTMX], response_class=HTMLResponse)
-async def get_online_collectors() -> str:
-    """Return ITN aliases and collector counts."""
-    try:
-        participants_count = app.state.connection.execute(
-            """SELECT address, COUNT(*) AS total_count,
-            SUM(CASE WHEN datetime(date_time) >= datetime('now', '-24 hours')
-            THEN 1 ELSE 0 END) AS count_24hr
-            FROM data_points
-            GROUP BY address ORDER BY total_count DESC;
-            """
-        )
-    except apsw.SQLError:
-        return "zero collectors online"
+@helpers.ttl_cache(CACHE_TTL)
+async def _collector_counts() -> list[reports.CollectorRow]:
+    """Return collector counts and per-feed averages for the online
+    collectors table, or None if they cannot be retrieved.
 
+    Averages are zero when no feeds were collected in the window.
+    """
     try:
-        feed_count = app.state.connection.execute(
-            """SELECT distinct feed_id
-            from data_points
-            where datetime(date_time) >= datetime('now', '-48 hours');
-            """
+        rows = await helpers.db_exec(
+            app, SQL_COLLECTOR_COUNTS, (WINDOW_24_HOURS, WINDOW_48_HOURS)
         )
     except apsw.SQLError:
-        return "zero collectors online"
+        return None
+    return [reports.CollectorRow(*row) for row in rows]
 
-    no_feeds = len(list(feed_count))
-
-    # FIXME: These can all be combined better, e.g. into a dataclass or
-    # somesuch. This is purely for expediency to have something up and
-    # running.
-    participants_count_total = {}
-    participants_count_24hr = {}
-    participant_count_24h_feed_average = {}
-    participant_count_1h_feed_average = {}
-    participant_count_1m_feed_average = {}
-
-    for row in participants_count:
-        address, total_count, count_24hr = row
-        participants_count_total[address] = total_count
-        participants_count_24hr[address] = count_24hr
-        try:
-            participant_count_24h_feed_average[address] = int(count_24hr / no_feeds) + 1
-            participant_count_1h_feed_average[address] = (
-                int(count_24hr / no_feeds / 24) + 1
-            )
-            participant_count_1m_feed_average[address] = round(
-                count_24hr / no_feeds / 24 / 60, 4
-            )
-        except ZeroDivisionError:
-            participant_count_24h_feed_average[address] = 0
-            participant_count_1h_feed_average[address] = 0
-            participant_count_1m_feed_average = 0
-
-    htmx = htm_helpers.participants_count_table(
-        participants_count_total,
-        participants_count_24hr,
-        participant_count_24h_feed_average,
-        participant_count_1h_feed_average,
-        participant_count_1m_feed_average,
-    )
-    return htmx.strip()
+
+@helpers.ttl_cache(CACHE_TTL)
+async def _locations_stake_key() -> dict:
+    """Return locations by stake key for the locations table."""
+    return await reports.get_locations_stake_key(app)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Return True if an If-None-Match header matches the ETag.
+
+    If-None-Match uses the weak comparison (RFC 7232 3.2) so a `W/`
+    prefix, e.g. added by a compressing reverse proxy, is ignored.
+    """
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _conditional_html(request: Request, data, render) -> Response:
+    """Return the HTML rendered from data, or 304 Not Modified if the
+    client already holds it.
+
+    The rendered HTML is determined entirely by data, so the ETag is
+    taken from the data. This avoids rendering to check for a match and
+    allows the HTML to be streamed.
+    """
+    etag = helpers.etag(data)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={HTTP_MAX_AGE}"}
+    if _etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(render(data), media_type="text/html", headers=headers)
+
+
+@app.get("/participants", tags=[TAG_HTMX], response_class=HTMLResponse)
+async def get_itn_participants(request: Request):
+    """Return ITN aliases and licenses."""
+    all_holders = await _license_holders()
+    return _conditional_html(request, all_holders, htm_helpers.aliases_to_html)
+
+
+@app.get("/online_collectors", tags=[TAG_HTMX], response_class=HTMLResponse)
+async def get_online_collectors(request: Request):
+    """Return ITN aliases and collector counts."""
+    counts = await _collector_counts()
+    if counts is None:
+        return "zero collectors online"
+    return _conditional_html(request, counts, htm_helpers.participants_count_table)
 
 
 @app.get("/locations", tags=[TAG_HTMX], response_class=HTMLResponse)
-async def get_locations_hx():
+async def get_locations_hx(request: Request):
     """Return countries participating in the ITN."""
-    locations = await reports.get_locations_stake_key(app)
-    return htm_helpers.locations_table(locations)
+    locations = await _locations_stake_key()
+    return _conditional_html(request, locations, htm_helpers.locations_table)
 
 
 @app.get("/locations_map", tags=[TAG_HTMX], response_class=HTMLResponse)
-async def get_locations_map_hx():
+async def get_locations_map_hx(request: Request):
     """Return countries participating in the ITN."""
     locations = await reports.get_locations(app)
-    return htm_helpers.locations_map(locations)
+    return _conditional_html(
+        request, locations, lambda locations: [htm_helpers.locations_map(locations)]
+    )
 
 
 @app.get("/count_active_participants", tags=[TAG_HTMX], response_class=HTMLResponse)
 async def count_active_participants():
     """Count active participants."""
     try:
-        participants = app.state.connection.execute(
-            "select count(distinct address) as count from data_points;"
-        )
+        data = await helpers.db_exec(app, SQL_COUNT_ACTIVE_PARTICIPANTS)
     except apsw.SQLError as err:
         return {"error": f"{err}"}
-    data = list(participants)
     return f"{data[0][0]}"
 
 
@@ -344,14 +483,34 @@ def main():
 
     parser.add_argument(
         "--workers",
-        help="enable more workers",
+        help="enable more workers (default: 2 * cpu + 1)",
         required=False,
-        default=1,
+        default=(os.cpu_count() or 1) * 2 + 1,
         type=int,
     )
 
+    parser.add_argument(
+        "--create-indexes",
+        help="create any missing database indexes and exit",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--debug",
+        help="enable debug and access logging",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+
     args = parser.parse_args()
 
+    if args.create_indexes:
+        _ensure_indexes(Path(os.environ["DATABASE_PATH"]))
+        return
+
     logger.info(
         "attempting API startup, try setting `--port` arg if there are any issues"
     )
@@ -370,8 +529,10 @@ def main():
         import_str,
         host="0.0.0.0",
         port=int(args.port),
-        access_log=True,
-        log_level="debug",
+        loop="uvloop",
+        http="httptools",
+        access_log=args.debug,
+        log_level="debug" if args.debug else "info",
         reload=args.reload,
         workers=args.workers,
     )
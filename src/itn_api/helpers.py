@@ -2,59 +2,153 @@
 
 # pylint: disable=W1203
 
+import asyncio
 import datetime
+import functools
+import hashlib
+import inspect
 import logging
 import time
 from typing import Final
 
+from fastapi import FastAPI
+
 logger = logging.getLogger(__name__)
 
 
 MINUTES_DAY: Final[int] = 1440
 MINUTES_HOUR: Final[int] = 60
 
+# Every cache created by `ttl_cache` so they can be cleared together.
+_caches: list[dict] = []
+
 
 def _function_name(func: str) -> str:
     """Attemptt to retrieve function name for timeit."""
     return str(func).rsplit("at", 1)[0].replace("<function", "function: ").strip()
 
 
+def _log_time_taken(func, start: float):
+    """Output the time taken since start for the given function."""
+    elapsed = time.perf_counter() - start
+    func_name = _function_name(str(func))
+    logger.info(f"Time taken: {elapsed:.6f} seconds ({func_name})")
+
+
 def timeit(func):
     """Decorator to output the time taken for a function"""
 
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = await func(*args, **kwargs)
+            _log_time_taken(func, start)
+            return result
+
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
         start = time.perf_counter()
         result = func(*args, **kwargs)
-        end = time.perf_counter()
-        elapsed = end - start
-        func_name = _function_name(str(func))
-        logger.info(f"Time taken: {elapsed:.6f} seconds ({func_name})")
+        _log_time_taken(func, start)
         return result
 
     return wrapper
 
 
-@timeit
+async def db_exec(app: FastAPI, sql: str, params: tuple = ()) -> list:
+    """Execute a query on a pooled connection in the database thread
+    pool so that the event loop is not blocked while SQLite works.
+
+    The connection is returned to the pool only once the query has
+    finished in its thread. If the request is cancelled while waiting,
+    e.g. the client disconnects, the query is left to complete so that
+    the connection is never used by two threads at once.
+    """
+    pool = app.state.pool
+    connection = await pool.get()
+    future = asyncio.get_running_loop().run_in_executor(
+        app.state.db_executor, lambda: list(connection.execute(sql, params))
+    )
+    future.add_done_callback(lambda _: pool.put_nowait(connection))
+    return await asyncio.shield(future)
+
+
+def ttl_cache(seconds: int, maxsize: int = 128):
+    """Decorator to cache the result of a function for `seconds`.
+
+    Results are keyed on the function name and its (sorted) arguments
+    so that each distinct set of query parameters is cached separately.
+    Both regular and async functions are supported.
+    """
+
+    def decorator(func):
+        cache = {}
+        _caches.append(cache)
+
+        def _key(args, kwargs) -> tuple:
+            return (func.__qualname__, args, tuple(sorted(kwargs.items())))
+
+        def _lookup(key):
+            entry = cache.get(key)
+            if entry and time.monotonic() - entry[0] < seconds:
+                return entry
+            return None
+
+        def _store(key, result):
+            if key not in cache and len(cache) >= maxsize:
+                del cache[next(iter(cache))]
+            cache[key] = (time.monotonic(), result)
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = _key(args, kwargs)
+                if entry := _lookup(key):
+                    return entry[1]
+                result = await func(*args, **kwargs)
+                _store(key, result)
+                return result
+
+            async_wrapper.cache_clear = cache.clear
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _key(args, kwargs)
+            if entry := _lookup(key):
+                return entry[1]
+            result = func(*args, **kwargs)
+            _store(key, result)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+def clear_caches():
+    """Clear every cache created by `ttl_cache`."""
+    for cache in _caches:
+        cache.clear()
+
+
+def etag(data) -> str:
+    """Return an HTTP ETag for the given data.
+
+    The data's repr is hashed so it should be built from plain values
+    and dataclasses whose repr is stable between calls.
+    """
+    digest = hashlib.blake2b(repr(data).encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
 def get_minutes(date_str_1: str, date_str_2: str) -> int:
     """Return minutes from two date strings."""
-    date_object_1 = datetime.datetime.strptime(date_str_1, "%Y-%m-%d")
-    date_object_2 = datetime.datetime.strptime(date_str_2, "%Y-%m-%d")
-    time_diff = date_object_2 - date_object_1
-    return int(time_diff.total_seconds() / 60)
-
-
-def update_dict(index: dict, key: str, value) -> dict:
-    """Update a dictionary of lists."""
-    try:
-        index[key].append(value)
-    except KeyError:
-        index[key] = [value]
-    return index
-
-
-def dedupe_dicts(index: dict) -> dict:
-    """De-duplicate a dictionary of lists."""
-    new_index = {}
-    for key, value in index.items():
-        new_index[key] = list(set(value))
-    return new_index
+    date_object_1 = datetime.date.fromisoformat(date_str_1)
+    date_object_2 = datetime.date.fromisoformat(date_str_2)
+    return (date_object_2 - date_object_1).days * MINUTES_DAY
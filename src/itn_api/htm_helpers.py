@@ -1,15 +1,77 @@
 """Helpers specifically for outputting HTML, i.e. for HTMX."""
 
+import functools
 import logging
+from typing import Final, Iterable, Iterator
 
-import folium
 import humanize
 
 logger = logging.getLogger(__name__)
 
+# The same counts recur across rows and requests, so humanize's output
+# is memoized. Both functions are pure for a given number; `typed`
+# keeps e.g. `1` and `1.0`, which format differently, apart.
+_intcomma = functools.lru_cache(maxsize=8192, typed=True)(humanize.intcomma)
+_intword = functools.lru_cache(maxsize=8192, typed=True)(humanize.intword)
 
-def aliases_to_html(alias_report: dict) -> str:
-    """Take the alias report and convert it to HTML.
+# Number of table rows sent per chunk when streaming a table.
+ROWS_PER_CHUNK: Final[int] = 100
+
+# Row templates for the tables below. Formatted with `%` so that the
+# layout is only parsed once, at import.
+ALIAS_ROW_TEMPLATE: Final[str] = (
+    """
+<tr>
+    <td>%s</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+    <td>%s</td>
+</tr>
+""".strip()
+)
+
+PARTICIPANTS_ROW_TEMPLATE: Final[str] = (
+    """
+<tr>
+    <td>%s</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+</tr>
+""".strip()
+)
+
+LOCATIONS_ROW_TEMPLATE: Final[str] = (
+    """
+<tr>
+    <td>%s</td>
+    <td>%s</td>
+    <td nowrap>&nbsp;%s&nbsp;</td>
+</tr>
+""".strip()
+)
+
+
+def _chunk_rows(rows: Iterable[str]) -> Iterator[str]:
+    """Join table rows into chunks of `ROWS_PER_CHUNK` rows so that a
+    streamed table isn't written one small row at a time.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(f"\n{row}")
+        if len(chunk) < ROWS_PER_CHUNK:
+            continue
+        yield "".join(chunk)
+        chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def aliases_to_html(alias_report: dict) -> Iterator[str]:
+    """Take the alias report and convert it to HTML, yielding the table
+    in chunks so that it can be streamed.
 
     e.g.
 
@@ -25,7 +87,8 @@ def aliases_to_html(alias_report: dict) -> str:
     logging.info("formatting alias table")
 
     if not alias_report:
-        return "no alias data available"
+        yield "no alias data available"
+        return
 
     head = """
 <table>
@@ -38,21 +101,19 @@ def aliases_to_html(alias_report: dict) -> str:
 
     """.strip()
 
-    rows = ""
-    count = 0
-    for alias in alias_report:
-        if alias.alias != "":
-            count += 1
-        row = f"""
-<tr>
-    <td>{alias.staking}</td>
-    <td nowrap>&nbsp;{humanize.intword(alias.staked)}&nbsp;</td>
-    <td nowrap>&nbsp;{", ".join(alias.licenses)}&nbsp;</td>
-    <td>{alias.alias}</td>
-</tr>
-        """.strip()
+    yield head
+    yield from _chunk_rows(
+        ALIAS_ROW_TEMPLATE
+        % (
+            alias.staking,
+            _intword(alias.staked),
+            ", ".join(alias.licenses),
+            alias.alias,
+        )
+        for alias in alias_report
+    )
 
-        rows = f"{rows}{row}\n"
+    count = sum(1 for alias in alias_report if alias.alias != "")
 
     count_row = f"""
 <tr>
@@ -62,22 +123,30 @@ def aliases_to_html(alias_report: dict) -> str:
     <td></td>
 </tr>
     """
-    return f"{head}\n{rows}\n{count_row}</table>\n"
+    yield f"\n\n{count_row}</table>\n"
+
+
+def participants_count_table(participants_counts: list) -> Iterator[str]:
+    """Yield a table with active participant counts.
 
+    e.g.
 
-def participants_count_table(
-    participants_count_total,
-    participants_count_24hr,
-    participant_count_24h_feed_average,
-    participant_count_1h_feed_average,
-    participant_count_1m_feed_average,
-):
-    """Return a table with active participant counts."""
+        CollectorRow(
+            staking='stake1uxta2uanum3zphefxkeu5nr5umykkr5rqz0exujddalhadgtmzxas',
+            total=1131,
+            count_24hr=1131,
+            average_24hr=378,
+            average_1hr=16,
+            average_1min=0.2618,
+        )
+
+    """
 
     logging.info("formatting participants table")
 
-    if not participants_count_total:
-        return "zero collectors online"
+    if not participants_counts:
+        yield "zero collectors online"
+        return
 
     head = """
 <table>
@@ -91,35 +160,30 @@ def participants_count_table(
     </tr>
     """.strip()
 
-    rows = ""
-    for stake_key, count in participants_count_total.items():
-        count_24hr = participants_count_24hr.get(stake_key, 0)
-        average_24hr = participant_count_24h_feed_average.get(stake_key, 0)
-        average_1hr = participant_count_1h_feed_average.get(stake_key, 0)
-        average_min = participant_count_1m_feed_average.get(stake_key, 0)
-        row = f"""
-<tr>
-    <td>{stake_key}</td>
-    <td nowrap>&nbsp;{humanize.intcomma(count)}&nbsp;</td>
-    <td nowrap>&nbsp;{humanize.intcomma(count_24hr)}&nbsp;</td>
-    <td nowrap>&nbsp;{humanize.intcomma(average_24hr)}&nbsp;</td>
-    <td nowrap>&nbsp;{humanize.intcomma(average_1hr)}&nbsp;</td>
-    <td nowrap>&nbsp;{humanize.intcomma(average_min)}&nbsp;</td>
-</tr>
-        """.strip()
-
-        rows = f"{rows}{row}\n"
-
-    return f"{head}\n{rows}</table>\n"
+    yield head
+    yield from _chunk_rows(
+        PARTICIPANTS_ROW_TEMPLATE
+        % (
+            row.staking,
+            _intcomma(row.total),
+            _intcomma(row.count_24hr),
+            _intcomma(row.average_24hr),
+            _intcomma(row.average_1hr),
+            _intcomma(row.average_1min),
+        )
+        for row in participants_counts
+    )
+    yield "\n</table>\n"
 
 
-def locations_table(locations):
-    """Create a table for participant locations."""
+def locations_table(locations) -> Iterator[str]:
+    """Yield a table for participant locations."""
 
     logging.info("formatting participants table")
 
     if not locations:
-        return "no locations available"
+        yield "no locations available"
+        return
 
     head = """
 <table>
@@ -130,22 +194,12 @@ def locations_table(locations):
     </tr>
     """.strip()
 
-    seen = []
-    rows = ""
-    idx = 0
-    for addr, locale in locations.items():
-        idx += 1
-        region = locale["region"]
-        country = locale["country"]
-        row = f"""
-<tr>
-    <td>{addr}</td>
-    <td>{region}</td>
-    <td nowrap>&nbsp;{country}&nbsp;</td>
-</tr>
-        """.strip()
-        seen.append((region, country))
-        rows = f"{rows}{row}\n"
+    yield head
+    yield from _chunk_rows(
+        LOCATIONS_ROW_TEMPLATE % (addr, locale["region"], locale["country"])
+        for addr, locale in locations.items()
+    )
+    idx = len(locations)
     country_count = f"""
 <tr>
     <td><b>Count</b></td>
@@ -153,7 +207,7 @@ def locations_table(locations):
 </tr>
         """.strip()
 
-    return f"{head}\n{rows}\n{country_count}</table>\n"
+    yield f"\n\n{country_count}</table>\n"
 
 
 def locations_map(locations):
@@ -164,11 +218,36 @@ def locations_map(locations):
     if not locations:
         return "no locations available"
 
+    # Collector locations change rarely so the map is cached against
+    # the exact locations it was rendered from.
+    return _render_locations_map(
+        tuple(
+            (
+                locale["region"],
+                locale["country"],
+                locale["latitude"],
+                locale["longitude"],
+            )
+            for locale in locations
+        )
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _render_locations_map(locations: tuple) -> str:
+    """Render the HTML for a map of (region, country, latitude,
+    longitude) locations.
+    """
+
+    # Folium is only needed here, so is imported lazily to keep it out of
+    # worker start-up.
+    import folium  # pylint: disable=C0415
+
     collectors_map = folium.Map(
         location=[0.0, 0.0], zoom_start=1, min_zoom=1, zoom_control=False, attr=" "
     )
 
-    seen = []
+    seen = set()
 
     collector_count = len(locations)
 
@@ -182,12 +261,7 @@ def locations_map(locations):
 
     collectors_map.get_root().html.add_child(folium.Element(collector_count_html))
 
-    for locale in locations:
-        region = locale["region"]
-        country = locale["country"]
-        latitude = locale["latitude"]
-        longitude = locale["longitude"]
-
+    for region, country, latitude, longitude in locations:
         if (region, country) in seen:
             continue
 
@@ -197,7 +271,7 @@ def locations_map(locations):
             icon=folium.Icon(color="blue", prefix="fa", icon="computer"),
         ).add_to(collectors_map)
 
-        seen.append((region, country))
+        seen.add((region, country))
 
     collectors_map_html = collectors_map._repr_html_()  # pylint: disable=W0212
 
@@ -2,28 +2,56 @@
 
 # pylint: disable=R0917,R0913,R0914
 
-import json
+import asyncio
+import csv
+import io
 import logging
-from collections import Counter
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Final, Iterator, List, Tuple
 
 import apsw
 import humanize
 from fastapi import FastAPI
 
-try:
-    import helpers
-    import simple_sign_helpers
-except ImportError:
-    try:
-        from src.itn_api import helpers, simple_sign_helpers
-    except ImportError:
-        from itn_api import helpers, simple_sign_helpers
-
+from . import helpers, simple_sign_helpers
 
 logger = logging.getLogger(__name__)
 
+# Seconds to cache participant reports for. A report whose range
+# includes the present may lag new data by up to this long, ranges in
+# the past don't change.
+REPORT_CACHE_TTL: Final[int] = 300
+
+# Collector locations are read out of each message's `raw_data` by
+# SQLite rather than parsing the JSON in Python.
+SQL_NODE_LOCATIONS: Final[str] = (
+    """
+    select node_id,
+    json_extract(raw_data, '$.message.identity.location.loc'),
+    json_extract(raw_data, '$.message.identity.location.region'),
+    json_extract(raw_data, '$.message.identity.location.country')
+    from data_points
+    group by node_id;
+    """
+)
+
+# The raw `date_time` comparison lets the last day be searched via the
+# date_time index and the unary `+` stops SQLite scanning the whole
+# address index to group instead.
+SQL_ADDRESS_LOCATIONS: Final[str] = (
+    """
+    select node_id, address,
+    json_extract(raw_data, '$.message.identity.location.loc'),
+    json_extract(raw_data, '$.message.identity.location.region'),
+    json_extract(raw_data, '$.message.identity.location.country')
+    from data_points
+    where date_time >= date('now', '-24 hours')
+    and datetime(date_time) >= datetime('now', '-24 hours')
+    group by +address;
+    """
+)
+
 
 @dataclass
 class LicenseHolder:
@@ -33,48 +61,49 @@ class LicenseHolder:
     alias: str = ""
 
 
-def _search_aliases(aliases: list[simple_sign_helpers.Alias], addr: str):
-    """Get the alias from the given list of aliases."""
-    alias_found = ""
-    for alias in aliases:
-        if alias.staking != addr:
-            continue
-        alias_found = alias.alias
-        break
-    return alias_found
+@dataclass
+class CollectorRow:
+    staking: str
+    total: int
+    count_24hr: int
+    average_24hr: int
+    average_1hr: int
+    average_1min: float
 
 
-def _get_all_alias_addr_data(
+async def _get_all_alias_addr_data(
     kupo_url: str, kupo_port: str, min_stake: int, license_no: str
 ):
     """Retrieve all alias and address data for all staking addresses.
 
     E.g. this is useful for understanding network state.
     """
-    aliases = simple_sign_helpers.get_itn_alias(kupo_url, kupo_port)
-    licenses = simple_sign_helpers.get_licenses(kupo_url, kupo_port)
-    staked = simple_sign_helpers.get_staked(kupo_url, kupo_port, min_stake)
-    license_holders = list(licenses.values())
-    fact_holders = list(staked.keys())
-    holders = list(set(license_holders).intersection(fact_holders))
-    all_license_data = _collate_simple(holders, staked, licenses, aliases)
-    if license_no:
-        needle = f"Validator License {license_no}"
-        return [lic for lic in all_license_data if needle in lic.licenses]
-    return all_license_data
+    # Each lookup is an independent, blocking round trip to Kupo so they
+    # are made concurrently in threads, off the event loop.
+    aliases, licenses, staked = await asyncio.gather(
+        asyncio.to_thread(simple_sign_helpers.get_itn_alias, kupo_url, kupo_port),
+        asyncio.to_thread(simple_sign_helpers.get_licenses, kupo_url, kupo_port),
+        asyncio.to_thread(
+            simple_sign_helpers.get_staked, kupo_url, kupo_port, min_stake
+        ),
+    )
+    wanted_license = f"Validator License {license_no}" if license_no else None
+    return _collate_simple(staked, licenses, aliases, wanted_license)
 
 
-def get_all_license_holders(app: FastAPI, min_stake: int, license_no: str) -> dict:
+async def get_all_license_holders(
+    app: FastAPI, min_stake: int, license_no: str
+) -> dict:
     """Get all license holders."""
-    alias_addr_data = _get_all_alias_addr_data(
+    alias_addr_data = await _get_all_alias_addr_data(
         app.state.kupo_url, app.state.kupo_port, min_stake, license_no
     )
     return alias_addr_data
 
 
-def get_all_license_holders_csv(app: FastAPI, min_stake: int, sort: str) -> str:
+async def get_all_license_holders_csv(app: FastAPI, min_stake: int, sort: str) -> str:
     """Return all license holder info as a CSV."""
-    alias_addr_data = _get_all_alias_addr_data(
+    alias_addr_data = await _get_all_alias_addr_data(
         app.state.kupo_url, app.state.kupo_port, min_stake, None
     )
     if sort.lower().strip() == "stake":
@@ -83,138 +112,117 @@ def get_all_license_holders_csv(app: FastAPI, min_stake: int, sort: str) -> str:
             key=lambda alias_addr_data: alias_addr_data.staked,
             reverse=True,
         )
-    csv = "idx,staking,license,value\n"
+    lines = ["idx,staking,license,value"]
     for idx, data in enumerate(alias_addr_data, 1):
         stake = humanize.intcomma(data.staked).replace(",", ".")
-        csv = f"{csv}{idx:0>4}, {data.staking}, {' '.join(data.licenses)}, {stake}\n"
-    return csv
+        lines.append(f"{idx:0>4}, {data.staking}, {' '.join(data.licenses)}, {stake}")
+    return "\n".join(lines) + "\n"
 
 
 def _collate_simple(
-    holders: list, staked: dict, licenses: dict, aliases: list
+    staked: dict, licenses: dict, aliases: list, wanted_license: str = None
 ) -> list[LicenseHolder]:
-    """Collate all basic license holder info."""
-    holders.sort()
-    all_holders = []
-    alias = ""
-    for holder in holders:
-        stake = staked[holder]
-        held = []
-        for license_name, address in licenses.items():
-            if address == holder:
-                held.append(license_name)
-        if aliases:
-            alias = _search_aliases(aliases, holder)
-        all_holders.append(
-            LicenseHolder(
-                staking=holder,
-                staked=int(stake / 1000000),
-                licenses=held,
-                alias=alias,
-            )
+    """Collate all basic license holder info.
+
+    Licenses, stake, and aliases are merged into a single record per
+    staking address. Only addresses that both hold a license and stake
+    are returned, and if `wanted_license` is given, only the address
+    holding it.
+    """
+    holder_rows = {}
+    for license_name, address in licenses.items():
+        holder_rows.setdefault(address, {"licenses": []})["licenses"].append(
+            license_name
         )
-    all_holders = sorted(
-        all_holders, key=lambda all_holders: all_holders.licenses, reverse=False
-    )
+    for address, stake in staked.items():
+        if address in holder_rows:
+            holder_rows[address]["staked"] = stake
+    for alias in aliases or []:
+        # The first alias registered for an address wins.
+        if alias.staking in holder_rows:
+            holder_rows[alias.staking].setdefault("alias", alias.alias)
+    all_holders = [
+        LicenseHolder(
+            staking=holder,
+            staked=int(row["staked"] / 1000000),
+            licenses=row["licenses"],
+            alias=row.get("alias", ""),
+        )
+        for holder, row in holder_rows.items()
+        if "staked" in row and (not wanted_license or wanted_license in row["licenses"])
+    ]
+    # Every record holds at least one license and each license has a
+    # single holder, so the first license is a unique sort key.
+    all_holders.sort(key=lambda holder: (holder.licenses[0], holder.staking))
     return all_holders
 
 
-def _get_basic_addr_data(kupo_url: str, kupo_port: int):
+@helpers.ttl_cache(simple_sign_helpers.KUPO_CACHE_TTL)
+async def _get_basic_addr_data(kupo_url: str, kupo_port: int):
     """Get all staking and license data for all staking addresses."""
-    licenses = simple_sign_helpers.get_licenses(kupo_url, kupo_port)
-    staked = simple_sign_helpers.get_staked(kupo_url, kupo_port)
-    license_holders = list(licenses.values())
-    fact_holders = list(staked.keys())
-    holders = list(set(license_holders).intersection(fact_holders))
-    all_license_data = _collate_simple(holders, staked, licenses, None)
+    licenses, staked = await asyncio.gather(
+        asyncio.to_thread(simple_sign_helpers.get_licenses, kupo_url, kupo_port),
+        asyncio.to_thread(simple_sign_helpers.get_staked, kupo_url, kupo_port),
+    )
+    all_license_data = _collate_simple(staked, licenses, None)
     return all_license_data
 
 
-def _get_unique_feeds(data: list) -> Tuple[list, list]:
-    """Get unique feeds per address."""
-    addresses = []
-    feeds = []
-    for item in data:
-        addr = item[0]
-        feed = item[2]
-        feeds.append(feed)
-        if addr in addresses:
-            continue
-        addresses.append(addr)
-    feeds = list(set(feeds))
-    return feeds, addresses
+def _group_participant_data(data: list) -> Tuple[list, dict, dict]:
+    """Group the per address and feed counts from the database by
+    address.
 
-
-def _get_addr_minute_feed_dicts(data: list, addresses: list):
-    """For all addresses, identify unique minutes collecting per feed
-    and all unique feeds collected.
+    Returns the unique feeds, the unique minutes collecting per address
+    (summed across feeds), and the data points per feed per address.
     """
-    # Sort behaves like an index and improves the performance of the
-    # next section of code organizing the data.
-    addresses.sort()
-    addr_minute_values = {}
-    addr_feed_values = {}
-    for addr in addresses:
-        for item in data:
-            if item[0] != addr:
-                continue
-            minutes = item[1].rsplit(":", 1)[0].strip()
-            feed = item[2].strip()
-            addr_minute_values = helpers.update_dict(
-                addr_minute_values, addr, f"{feed}|{minutes}"
-            )
-            addr_feed_values = helpers.update_dict(addr_feed_values, addr, feed)
-    return addr_minute_values, addr_feed_values
-
-
-def _get_license_and_stake(
-    address_data: list[LicenseHolder], addr: str
-) -> Tuple[str, str]:
-    """Get license and stake for a given address."""
-    license_name = None
-    staking = None
-    for address in address_data:
-        if address.staking != addr:
-            continue
-        license_name = ", ".join(address.licenses)
-        staking = address.staked
-    return license_name, staking
+    feeds = set()
+    addr_minutes = defaultdict(int)
+    addr_feed_counts = defaultdict(dict)
+    for addr, feed, minutes, data_points in data:
+        feeds.add(feed)
+        addr_minutes[addr] += minutes
+        addr_feed_counts[addr][feed] = data_points
+    return sorted(feeds), addr_minutes, addr_feed_counts
 
 
 def _process_json_report(
     address_data: list[LicenseHolder],
     date_start: str,
     date_end: str,
-    addr_minute_values: dict,
-    addr_feed_values: dict,
+    addr_minutes: dict,
+    addr_feed_counts: dict,
     feeds: list,
 ) -> dict:
     """Create the JSON report from the given data."""
     # Combine counts into a report.
     minutes_in_range = helpers.get_minutes(date_start, date_end)
     days_in_range = minutes_in_range / helpers.MINUTES_DAY
+    license_and_stake = {
+        address.staking: (", ".join(address.licenses), address.staked)
+        for address in address_data
+    }
+    # Feeds are already unique so the count is constant for every address.
+    number_of_feeds = len(feeds)
     counts = {}
-    for addr, value in addr_minute_values.items():
-        total_mins = len(set(value))
-        average_mins = total_mins / len(set(feeds))
-        license_name, stake = _get_license_and_stake(address_data, addr)
+    for addr, total_mins in addr_minutes.items():
+        average_mins = total_mins / number_of_feeds
+        license_name, stake = license_and_stake.get(addr, (None, None))
         counts[addr] = {
             "license": license_name,
             "stake": stake,
             "total_data_points": total_mins,
             "average_mins_collecting_per_feed": int(average_mins),
             "total_mins_in_date_range": minutes_in_range,
-            "number_of_feeds_collected": len(set(addr_feed_values[addr])),
+            "number_of_feeds_collected": len(addr_feed_counts[addr]),
             "feeds_count": [
-                f"{key}: {value}"
-                for key, value in Counter(addr_feed_values[addr]).items()
+                f"{key}: {value}" for key, value in addr_feed_counts[addr].items()
             ],
         }
     report = {}
     report["start"] = date_start
     report["end"] = date_end
-    report["expected_number_of_feeds"] = len(feeds)
-    report["max_possible_data_points"] = minutes_in_range * len(feeds)
+    report["expected_number_of_feeds"] = number_of_feeds
+    report["max_possible_data_points"] = minutes_in_range * number_of_feeds
     report["data"] = counts
     report["expected_feeds"] = feeds
     report["total_days_in_date_range"] = int(days_in_range)
@@ -222,41 +230,61 @@ def _process_json_report(
 
 
 @helpers.timeit
-def get_participants_counts_date_range(
+async def get_participants_counts_date_range(
     app: FastAPI, date_start: str, date_end: str
 ) -> dict:
     """Return participants report by date range."""
-    data = _get_participant_data_by_date_range(app, date_start, date_end)
-    feeds, addresses = _get_unique_feeds(data)
+    return await _get_participants_counts_report(app, date_start, date_end)
+
+
+@helpers.ttl_cache(REPORT_CACHE_TTL, maxsize=64)
+async def _get_participants_counts_report(
+    app: FastAPI, date_start: str, date_end: str
+) -> dict:
+    """Create the participants report for the date range, caching it
+    as the same ranges are requested repeatedly.
+    """
+    data = await _get_participant_data_by_date_range(app, date_start, date_end)
+    feeds, addr_minutes, addr_feed_counts = _group_participant_data(data)
     logger.info("no feeds: '%s'", len(feeds))
-    logger.info("no addresses: '%s'", len(feeds))
-    addr_minute_values, addr_feed_values = _get_addr_minute_feed_dicts(data, addresses)
-    addr_minute_values = helpers.dedupe_dicts(addr_minute_values)
-    address_data = _get_basic_addr_data(app.state.kupo_url, app.state.kupo_port)
+    logger.info("no addresses: '%s'", len(addr_minutes))
+    address_data = await _get_basic_addr_data(app.state.kupo_url, app.state.kupo_port)
     report = _process_json_report(
-        address_data, date_start, date_end, addr_minute_values, addr_feed_values, feeds
+        address_data, date_start, date_end, addr_minutes, addr_feed_counts, feeds
     )
     return report
 
 
-def _get_participant_data_by_date_range(
+async def _get_participant_data_by_date_range(
     app: FastAPI, date_start: str, date_end: str
 ) -> list:
-    """Query the database and get the results."""
-    participants = app.state.connection.execute(
-        f"""
-            select address, date_time, feed_id
-            from data_points
-            where date_time > date('{date_start}')
-            and date_time < date('{date_end}')
-            order by address;
+    """Query the database and get the results.
+
+    Returns the unique minutes collecting and total data points for each
+    address and feed. Minutes are the first 16 characters of the ISO 8601
+    `date_time`, i.e. `YYYY-MM-DDTHH:MM`.
+    """
+    participants = await helpers.db_exec(
+        app,
         """
+            select address, trim(feed_id) as feed,
+            count(distinct substr(date_time, 1, 16)) as minutes,
+            count(*) as data_points
+            from data_points
+            where date_time > date(?)
+            and date_time < date(?)
+            group by address, feed
+            order by address, feed;
+        """,
+        (date_start, date_end),
     )
-    return list(participants)
+    return participants
 
 
-def generate_participant_count_csv(report: dict) -> str:
-    """Convert JSON data into a CSV for ease of use."""
+def generate_participant_count_csv(report: dict) -> Iterator[str]:
+    """Convert JSON data into a CSV for ease of use, yielding it a line
+    at a time so that it can be streamed.
+    """
 
     max_possible = report.get("max_possible_data_points")
     start = report.get("start")
@@ -264,43 +292,63 @@ def generate_participant_count_csv(report: dict) -> str:
     max_feeds = report.get("expected_number_of_feeds", 1)
     data = report.get("data", {})
     total_days_in_range = report.get("total_days_in_date_range", 0)
-    feed_cols = [""] * (max_feeds * 2)
-    rows = []
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    def _line(row: list) -> str:
+        """Return a row formatted as a CSV line."""
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue()
+
+    yield _line(
+        [
+            "participant",
+            "license",
+            "stake",
+            "days_in_range",
+            "max_possible",
+            "start",
+            "end",
+            "total_collected",
+            "total_data_points",
+            "avg_per_feed",
+        ]
+        + [""] * (max_feeds * 2)
+    )
     for stake_addr, value in data.items():
-        participant = stake_addr
-        license_no = value.get("license", "").replace("Validator License", "").strip()
-        stake = humanize.intcomma(int(value.get("stake", 0))).replace(",", ".")
-        total_data_points = value.get("total_data_points", 0)
-        average_per_feed = value.get("average_mins_collecting_per_feed", 0)
-        total_collected = value.get("number_of_feeds_collected", 0)
-        participant_feeds = [""] * max_feeds
+        license_no = (value.get("license") or "").replace("Validator License", "")
+        stake = humanize.intcomma(int(value.get("stake") or 0)).replace(",", ".")
+        participant_feeds = [""] * (max_feeds * 2)
         for idx, count in enumerate(value.get("feeds_count", [])):
-            participant_feeds[idx] = ",".join([c.strip() for c in count.split(":")])
-        row = (
-            f'{participant}, "{license_no}", {stake}, {total_days_in_range}, '
-            f'"{humanize.intcomma(max_possible)}",'
-            f'{start}, {end}, "{humanize.intcomma(total_collected)}",'
-            f'"{humanize.intcomma(total_data_points)}", '
-            f' "{humanize.intcomma(average_per_feed)}", '
-            f"{','.join(participant_feeds)}"
+            feed, feed_count = count.rsplit(":", 1)
+            participant_feeds[idx * 2] = feed.strip()
+            participant_feeds[idx * 2 + 1] = feed_count.strip()
+        yield _line(
+            [
+                stake_addr,
+                license_no.strip(),
+                stake,
+                total_days_in_range,
+                humanize.intcomma(max_possible),
+                start,
+                end,
+                humanize.intcomma(value.get("number_of_feeds_collected", 0)),
+                humanize.intcomma(value.get("total_data_points", 0)),
+                humanize.intcomma(value.get("average_mins_collecting_per_feed", 0)),
+            ]
+            + participant_feeds
         )
-        rows.append(row.strip())
-    csv_header = (
-        f"participant, license, stake, days_in_range, max_possible, start, end, "
-        f"total_collected, total_data_points, avg_per_feed, {','.join(feed_cols)}"
-    )
-    csv = f"{csv_header}\n"
-    for row in rows:
-        csv = f"{csv}{row}\n"
-    return csv
 
 
 async def get_date_ranges(app: FastAPI):
     """Return min and max dates from the database."""
-    min_max_dates = app.state.connection.execute(
-        "select min(date_time), max(date_time) from data_points;"
+    min_max_dates = await helpers.db_exec(
+        app, "select min(date_time), max(date_time) from data_points;"
     )
-    dates = list(min_max_dates)[0]
+    dates = min_max_dates[0]
     return {
         "earliest_date": dates[0],
         "latest_date": dates[1],
@@ -316,34 +364,24 @@ async def get_locations(app: FastAPI) -> list:
 
     """
     try:
-        unique_raw_data = app.state.connection.execute(
-            "select min(node_id), raw_data from data_points group by node_id;"
-        )
+        res = await helpers.db_exec(app, SQL_NODE_LOCATIONS)
     except apsw.SQLError:
         return "zero collectors online"
 
-    res = list(unique_raw_data)
     countries = []
-    for item in res:
-        node = item[0]
-        message = json.loads(item[1])
-        try:
-            loc = message["message"]["identity"]["location"]
-            geo = loc.get("loc")
-            latitude, longitude = map(float, geo.split(","))
-
-            countries.append(
-                (
-                    {
-                        "latitude": latitude,
-                        "longitude": longitude,
-                        "region": loc.get("region"),
-                        "country": loc.get("country"),
-                    }
-                )
-            )
-        except KeyError as err:
-            logger.error("node: '%s' not reporting location (%s)", node, err)
+    for node, geo, region, country in res:
+        if not geo:
+            logger.error("node: '%s' not reporting location", node)
+            continue
+        latitude, longitude = map(float, geo.split(","))
+        countries.append(
+            {
+                "latitude": latitude,
+                "longitude": longitude,
+                "region": region,
+                "country": country,
+            }
+        )
     return countries
 
 
@@ -357,32 +395,20 @@ async def get_locations_stake_key(app: FastAPI) -> list:
 
     """
     try:
-        unique_raw_data = app.state.connection.execute(
-            """select node_id, raw_data, min(address), date_time
-            from data_points
-            where datetime(date_time) >= datetime('now', '-24 hours')
-            group by address;
-            """
-        )
+        res = await helpers.db_exec(app, SQL_ADDRESS_LOCATIONS)
     except apsw.SQLError:
         return "zero collectors online"
 
-    res = list(unique_raw_data)
     key_loc = {}
-    for item in res:
-        node = item[0]
-        address = item[2]
+    for node, address, geo, region, country in res:
         if address in key_loc:
             continue
-        message = json.loads(item[1])
-        try:
-            loc = message["message"]["identity"]["location"]
-            country = {
-                "geo": loc.get("loc"),
-                "region": loc.get("region"),
-                "country": loc.get("country"),
-            }
-            key_loc[address] = country
-        except KeyError as err:
-            logger.error("node: '%s' not reporting location (%s)", node, err)
+        if geo is None and region is None and country is None:
+            logger.error("node: '%s' not reporting location", node)
+            continue
+        key_loc[address] = {
+            "geo": geo,
+            "region": region,
+            "country": country,
+        }
     return key_loc
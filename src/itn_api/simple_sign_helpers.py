@@ -1,8 +1,6 @@
 """Helpers for working with simple-sign to retrieve license data.
 """
 
-import binascii
-import copy
 from dataclasses import dataclass
 from typing import Final
 
@@ -10,6 +8,8 @@ import pycardano as pyc
 from simple_sign.backend import KupoContext
 from simple_sign.types import Alias
 
+from . import helpers
+
 
 @dataclass
 class LicenseHolder:
@@ -26,20 +26,22 @@ NFT_SUFFIX_UNUSED: Final[str] = "000de140"
 ITN_ALIAS_VALUE: Final[int] = 1246010
 METADATA_TAG: Final[str] = "674"
 
+# Seconds to cache Kupo lookups for. License, stake, and alias data only
+# change on-chain so are slow moving relative to API requests.
+KUPO_CACHE_TTL: Final[int] = 60
+
 
+@helpers.ttl_cache(KUPO_CACHE_TTL)
 def get_staked(kupo_url: str, kupo_port: int, min_stake=MIN_FACT):
     """Get $FACT staking values."""
     context = KupoContext(kupo_url, kupo_port)
     staking = context.retrieve_staked_holders(
         token_policy=FACT_POLICY,
     )
-    for k, v in copy.deepcopy(staking).items():
-        if v > min_stake:
-            continue
-        del staking[k]
-    return staking
+    return {k: v for k, v in staking.items() if v > min_stake}
 
 
+@helpers.ttl_cache(KUPO_CACHE_TTL)
 def get_licenses(kupo_url: str, kupo_port: int):
     """Get license holders."""
     context = KupoContext(kupo_url, kupo_port)
@@ -47,15 +49,12 @@ def get_licenses(kupo_url: str, kupo_port: int):
         policy=LICENSE_POLICY,
         deny_list=[ORCFAX_MINT],
     )
+    # Keys are the policy ID followed by the hex encoded asset name.
+    prefix_len = len(LICENSE_POLICY)
     holders = {}
     for k, v in md.items():
-        name = (
-            k.replace(LICENSE_POLICY, "")
-            .replace(".", "")
-            .replace(NFT_SUFFIX_UNUSED, "")
-        )
-        name = binascii.unhexlify(name).decode()
-        holders[name] = v
+        name = k[prefix_len:].replace(".", "").replace(NFT_SUFFIX_UNUSED, "")
+        holders[bytes.fromhex(name).decode("ascii")] = v
     return holders
 
 
@@ -98,6 +97,7 @@ def identify_aliases_callback(md: list[dict]) -> list[Alias]:
     return addresses
 
 
+@helpers.ttl_cache(KUPO_CACHE_TTL)
 def get_itn_alias(kupo_url: str, kupo_port: str):
     """Get builder festival aliased addresses."""
     context = KupoContext(kupo_url, kupo_port)
@@ -1,8 +1,224 @@
 """Placeholder tests."""
 
-from src.itn_api.api import main
+# pylint: disable=W0212
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import apsw
+from simple_sign.types import Alias
+
+from src.itn_api import helpers, reports
+from src.itn_api.api import _etag_matches, main
 
 
 def test_none():
     """Ensure the main function for the template repository exists."""
     assert main
+
+
+def test_ttl_cache():
+    """Ensure results are cached per argument until cleared."""
+    calls = []
+
+    @helpers.ttl_cache(60)
+    def double(value: int) -> int:
+        calls.append(value)
+        return value * 2
+
+    assert double(2) == 4
+    assert double(2) == 4
+    assert double(value=3) == 6
+    assert calls == [2, 3]
+    helpers.clear_caches()
+    assert double(2) == 4
+    assert calls == [2, 3, 2]
+
+
+def test_get_minutes():
+    """Ensure minutes are counted between two dates."""
+    assert helpers.get_minutes("2024-01-01", "2024-01-01") == 0
+    assert helpers.get_minutes("2024-01-01", "2024-01-03") == 2880
+    assert helpers.get_minutes("2024-02-28", "2024-03-01") == 2880
+
+
+def test_etag_matches():
+    """Ensure If-None-Match uses the weak comparison and matches `*`."""
+    etag = '"abc"'
+    assert _etag_matches('"abc"', etag)
+    assert _etag_matches('W/"abc"', etag)
+    assert _etag_matches('"xyz", W/"abc"', etag)
+    assert _etag_matches("*", etag)
+    assert not _etag_matches('"xyz"', etag)
+    assert not _etag_matches("", etag)
+
+
+def _participants_report() -> dict:
+    """Return a participants report built from known database rows."""
+    rows = [
+        ("stake1", "ADA-USD", 10, 12),
+        ("stake1", "BTC-USD", 6, 6),
+        ("stake2", "ADA-USD", 4, 5),
+    ]
+    address_data = [
+        reports.LicenseHolder(
+            staking="stake1", staked=500000, licenses=["Validator License #001"]
+        )
+    ]
+    feeds, addr_minutes, addr_feed_counts = reports._group_participant_data(rows)
+    return reports._process_json_report(
+        address_data, "2024-01-01", "2024-01-02", addr_minutes, addr_feed_counts, feeds
+    )
+
+
+def test_process_json_report():
+    """Ensure grouped participant counts are reported per address."""
+    report = _participants_report()
+    assert report["start"] == "2024-01-01"
+    assert report["end"] == "2024-01-02"
+    assert report["expected_feeds"] == ["ADA-USD", "BTC-USD"]
+    assert report["expected_number_of_feeds"] == 2
+    assert report["max_possible_data_points"] == 2880
+    assert report["total_days_in_date_range"] == 1
+    assert report["data"] == {
+        "stake1": {
+            "license": "Validator License #001",
+            "stake": 500000,
+            "total_data_points": 16,
+            "average_mins_collecting_per_feed": 8,
+            "total_mins_in_date_range": 1440,
+            "number_of_feeds_collected": 2,
+            "feeds_count": ["ADA-USD: 12", "BTC-USD: 6"],
+        },
+        "stake2": {
+            "license": None,
+            "stake": None,
+            "total_data_points": 4,
+            "average_mins_collecting_per_feed": 2,
+            "total_mins_in_date_range": 1440,
+            "number_of_feeds_collected": 1,
+            "feeds_count": ["ADA-USD: 5"],
+        },
+    }
+
+
+def test_get_participant_data_by_date_range():
+    """Ensure feeds are trimmed and minutes are counted once per minute
+    within the date range.
+    """
+    connection = apsw.Connection(":memory:")
+    connection.execute(
+        "create table data_points(date_time text, address text, feed_id text);"
+    )
+    connection.executemany(
+        "insert into data_points values (?, ?, ?);",
+        [
+            ("2024-01-01T10:00:01Z", "stake1", " ADA-USD "),
+            ("2024-01-01T10:00:59Z", "stake1", "ADA-USD"),
+            ("2024-01-01T10:01:00Z", "stake1", "ADA-USD"),
+            ("2024-01-01T10:00:00Z", "stake2", "BTC-USD"),
+            ("2024-01-03T10:00:00Z", "stake2", "BTC-USD"),
+        ],
+    )
+    pool = asyncio.Queue()
+    pool.put_nowait(connection)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        app = SimpleNamespace(state=SimpleNamespace(pool=pool, db_executor=executor))
+        data = asyncio.run(
+            reports._get_participant_data_by_date_range(app, "2024-01-01", "2024-01-02")
+        )
+    assert data == [("stake1", "ADA-USD", 2, 3), ("stake2", "BTC-USD", 1, 1)]
+
+
+def test_collate_simple():
+    """Ensure only staked license holders are collated, the first alias
+    wins, the license filter applies, and holders are ordered by license.
+    """
+    licenses = {
+        "Validator License #002": "stake_b",
+        "Validator License #001": "stake_a",
+        "Validator License #003": "stake_a",
+        "Validator License #004": "stake_c",
+    }
+    staked = {"stake_a": 2000000000, "stake_b": 1000000000, "stake_d": 5000000000}
+    aliases = [
+        Alias(alias="addr_a1", address="a1", staking="stake_a", tx="t1"),
+        Alias(alias="addr_a2", address="a2", staking="stake_a", tx="t2"),
+        Alias(alias="addr_d", address="d", staking="stake_d", tx="t3"),
+    ]
+    assert reports._collate_simple(staked, licenses, aliases) == [
+        reports.LicenseHolder(
+            staking="stake_a",
+            staked=2000,
+            licenses=["Validator License #001", "Validator License #003"],
+            alias="addr_a1",
+        ),
+        reports.LicenseHolder(
+            staking="stake_b", staked=1000, licenses=["Validator License #002"]
+        ),
+    ]
+    wanted = reports._collate_simple(
+        staked, licenses, aliases, "Validator License #002"
+    )
+    assert [holder.staking for holder in wanted] == ["stake_b"]
+    assert not reports._collate_simple(staked, licenses, None, "Validator License #004")
+
+
+def test_generate_participant_count_csv():
+    """Ensure the participants CSV layout and quoting, including a
+    participant without a license or stake.
+    """
+    lines = list(reports.generate_participant_count_csv(_participants_report()))
+    assert lines == [
+        "participant,license,stake,days_in_range,max_possible,start,end,"
+        "total_collected,total_data_points,avg_per_feed,,,,\n",
+        'stake1,#001,500.000,1,"2,880",2024-01-01,2024-01-02,2,16,8,'
+        "ADA-USD,12,BTC-USD,6\n",
+        'stake2,,0,1,"2,880",2024-01-01,2024-01-02,1,4,2,ADA-USD,5,,\n',
+    ]
+
+
+def test_db_exec_cancelled_keeps_connection_until_done():
+    """Ensure a cancelled query's connection is only returned to the pool
+    once the query has finished in its thread.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def block() -> int:
+        started.set()
+        release.wait(5)
+        return 1
+
+    connection = apsw.Connection(":memory:")
+    connection.createscalarfunction("block", block, 0)
+
+    async def run():
+        pool = asyncio.Queue()
+        pool.put_nowait(connection)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            app = SimpleNamespace(
+                state=SimpleNamespace(pool=pool, db_executor=executor)
+            )
+            task = asyncio.create_task(helpers.db_exec(app, "select block();"))
+            await asyncio.to_thread(started.wait, 5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            assert task.cancelled()
+            assert pool.empty()
+            release.set()
+            assert await asyncio.wait_for(pool.get(), 5) is connection
+
+    asyncio.run(run())
+
+
+def test_generate_participant_count_csv_feed_with_colons():
+    """Ensure only the last `:` separates a feed's name from its count."""
+    report = {
+        "expected_number_of_feeds": 1,
+        "data": {"stake1": {"feeds_count": ["CER:ADA:USD: 7"]}},
+    }
+    lines = list(reports.generate_participant_count_csv(report))
+    assert lines[1].endswith(",CER:ADA:USD,7\n")